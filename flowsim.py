@@ -31,22 +31,92 @@
 # simulator cannot currently simulate.
 
 from collections import deque
-from random import shuffle, random
-import subprocess
+import heapq
 
 all_metrics = []
 class metric:
+    # All simulation objects declare __slots__: they are created once but
+    # their attributes are read and written millions of times in the tick
+    # loop, and slot access is faster (and smaller) than a per-instance
+    # __dict__ lookup.
+    __slots__ = ('fn', 'f', 'buf', 'last_t', 'last_v', 'pend')
     def __init__(self, name):
         self.fn = "out/" + name + ".dat"
-        self.f = open(self.fn, "w")
+        # A large file buffer, so that even the bulk flushes below reach
+        # the OS in a handful of big writes.
+        self.f = open(self.fn, "w", buffering=1<<20)
+        self.buf = []
+        # Most metrics sit on the same value for long stretches of ticks,
+        # and the plots draw the samples "with lines", so the interior
+        # points of a constant run add nothing to the graph. We therefore
+        # only record a sample when the value changes, plus the *last*
+        # sample of the run that just ended (so the plotted line stays
+        # flat up to the change instead of sloping from the run's start).
+        # last_t and last_v track the most recent sample; pend says
+        # whether it is a still-unwritten run endpoint.
+        self.last_t = 0
+        self.last_v = None
+        self.pend = False
         all_metrics.append(self)
+    # out() is called for every sample - for some metrics, once per tick -
+    # so it must be cheap: a repeated value is just remembered as the
+    # pending endpoint of the current run, and a changed value appends
+    # the formatted line(s) to a buffer which flush() writes in bulk,
+    # instead of doing a separate tiny file write per sample.
     def out(self, t, value):
-        self.f.write("%s %s\n" % (t, value))        
+        if value == self.last_v:
+            self.last_t = t
+            self.pend = True
+            return
+        if self.pend:
+            self.buf.append("%s %s\n" % (self.last_t, self.last_v))
+            self.pend = False
+        self.buf.append("%s %s\n" % (t, value))
+        self.last_v = value
+        if len(self.buf) >= 65536:
+            self.flush()
+    # Record k consecutive per-tick samples t, t+1, ..., t+k-1 which all
+    # have the same value. Used when the simulation skips over a stretch
+    # of ticks in which nothing changes (see the event skip in
+    # workload_variable_concurrency).
+    def out_run(self, t, k, value):
+        if value != self.last_v:
+            if self.pend:
+                self.buf.append("%s %s\n" % (self.last_t, self.last_v))
+            self.buf.append("%s %s\n" % (t, value))
+            self.last_v = value
+            if k == 1:
+                self.pend = False
+                return
+        self.last_t = t + k - 1
+        self.pend = True
+    # Write out the buffered samples, including the pending endpoint of
+    # the current run - flushing mid-run just leaves a harmless interior
+    # point in the file. Flushing every 64K samples (see out) keeps the
+    # buffer's memory use bounded on very long simulations.
+    def flush(self):
+        if self.pend:
+            self.buf.append("%s %s\n" % (self.last_t, self.last_v))
+            self.pend = False
+        if self.buf:
+            self.f.writelines(self.buf)
+            self.buf.clear()
+
+# Replica completion is accounted in integer fixed point with FP_BITS
+# fractional bits (see replica.tick), rather than in a float: integer
+# addition doesn't drift no matter how many ticks we accumulate, bulk
+# addition of k ticks is exact (speed_fp * k), and extracting the number
+# of completed requests is a single shift instead of a float conversion.
+FP_BITS = 30
+FP_ONE = 1 << FP_BITS
 
 # A "replica" object is used to simulate a replica - a base-table replica
 # or a view-table replica. On this object one can write() to start a
 # write request, and tick() to advance to the next tick in the simulation.
 class replica:
+    __slots__ = ('id', 'ntick', 'write_speed', 'speed_fp', 'completion_fp',
+        'nwritten', 'nreplied', 'ncollected', 'metric_pending',
+        'view_replica')
     # id:    Identification string for this replica (used just for metric
     #        file name).
     # speed: Number of write() calls that can be completed per tick.
@@ -68,35 +138,78 @@ class replica:
         self.id = id
         self.ntick = 0
         self.write_speed = speed
-        self.completion = 0.0
-        self.requests = deque()
-        self.replies = deque()
+        self.speed_fp = round(speed * FP_ONE)
+        self.completion_fp = 0
+        # The queue of outstanding requests. Because write() appends and
+        # tick() completes requests in strict FIFO order, and because the
+        # coordinator sends every request to every one of its replicas in
+        # the same order (and a view replica sees the same order as its
+        # base replica), a replica doesn't need to remember *which*
+        # requests it holds - the coordinator already has that list (its
+        # "issued" log). A replica only keeps three integer cursors into
+        # that shared sequence: nwritten counts the requests it received,
+        # nreplied counts how many (from the head) it already completed,
+        # and ncollected counts how many completions the coordinator
+        # already picked up. The pending queue length is simply
+        # nwritten - nreplied, and both writing and completing a request
+        # are single integer additions.
+        self.nwritten = 0
+        self.nreplied = 0
+        self.ncollected = 0
         self.metric_pending = metric("replica_%s_write_queue" % (id))
         if view_replica_speed:
             self.view_replica = replica("v" + str(id), view_replica_speed, 0)
         else:
             self.view_replica = None
     def write(self, rid):
-        self.requests.append(rid)
+        self.nwritten += 1
         if self.view_replica:
             self.view_replica.write(rid)
+    # Number of requests still queued on this replica (written but not
+    # yet completed).
+    def pending(self):
+        return self.nwritten - self.nreplied
     # Each tick clears "cql_write_speed" writes from the queue.
+    # This function runs once per simulated tick per replica - i.e.,
+    # millions of times in a typical simulation - so it avoids repeated
+    # attribute lookups by working on local variables and storing the
+    # results back just once.
     def tick(self):
-        if self.requests:
-            self.completion += self.write_speed;
+        pending = self.nwritten - self.nreplied
+        if pending:
+            completion = self.completion_fp + self.speed_fp
             # A test - increase speed by 100% every 100,000 ticks.
-            # self.completion += self.write_speed * (1.0+self.ntick/100000.0)
-            while (self.completion >= 1.0):
-                self.completion -= 1.0
-                self.replies.append(self.requests.popleft())
-        self.ntick += 1
-        self.metric_pending.out(self.ntick, len(self.requests))
+            # completion += round(self.speed_fp * self.ntick/100000.0)
+            n = completion >> FP_BITS
+            if n:
+                if n > pending:
+                    n = pending
+                completion -= n << FP_BITS
+                self.nreplied += n
+                pending -= n
+            self.completion_fp = completion
+        ntick = self.ntick + 1
+        self.ntick = ntick
+        self.metric_pending.out(ntick, pending)
+    # Advance k ticks at once. The caller (the event skip in
+    # workload_variable_concurrency) has already verified that nothing
+    # happens on this replica during these ticks - no write() arrives and
+    # no queued request completes - so only the completion fraction and
+    # the per-tick metric samples need to advance.
+    def tick_skip(self, k):
+        pending = self.nwritten - self.nreplied
+        if pending:
+            # Fixed-point accounting makes the bulk addition exact - it
+            # is the same integer as k single-tick additions, so skipping
+            # doesn't change the simulation.
+            self.completion_fp += self.speed_fp * k
+        ntick = self.ntick
+        self.ntick = ntick + k
+        self.metric_pending.out_run(ntick + 1, k, pending)
     def all_nodes(self):
-        ret = set()
-        ret.add(self)
         if self.view_replica:
-            ret.add(self.view_replica)
-        return ret
+            return (self, self.view_replica)
+        return (self,)
 
 # Various mv pressure functions, returning delay amount (in ticks) based # on the coordinator's current state (e.g., its base replicas' view backlogs,
 # previously saved variables, etc.
@@ -126,10 +239,11 @@ def mv_pressure_linear_controller(c, alpha):
 # alpha = 1.0 (currently saved as a member field in the controller object)
 # and slowly varies it to achieve a desired backlog length dbacklog.
 def mv_pressure_linear_changing_alpha(c, dbacklog):
-    if not hasattr(c, 'alpha'):
-        c.alpha = 1.0
     backlog = c.view_backlog()
-    if abs(backlog - dbacklog)/dbacklog < 0.1:
+    # Note the multiplication instead of the obvious (and slower)
+    # abs(backlog - dbacklog)/dbacklog < 0.1, which would also divide by
+    # zero when dbacklog is 0.
+    if 10 * abs(backlog - dbacklog) < dbacklog:
         # if backlog is close enough (within 10%) to dbacklog, then alpha
         # is good enough and we don't continue to improve it. This will
         # save us from oscillations around the perfect alpha and of the
@@ -154,8 +268,6 @@ def mv_pressure_linear_changing_alpha(c, dbacklog):
 # slowly increase it.
 def mv_pressure_formula_2(c):
     backlog = c.view_backlog()
-    if not hasattr(c, 'prev_delay'):
-        c.prev_delay = 0
     if backlog > 1:
         delay = (c.prev_delay+1)*1.001
     else:
@@ -170,12 +282,7 @@ def mv_pressure_formula_2(c):
 # is growing quickly, we grow the delay quickly too.
 def mv_pressure_formula_3(c):
     backlog = c.view_backlog()
-    if not hasattr(c, 'prev_delay'):
-        c.prev_delay = 0.0
-    if not hasattr(c, 'prev_backlog'):
-        c.prev_backlog = 0
     if backlog > 1:
-        print(backlog - c.prev_backlog)
         delta = 1 + c.prev_delay * (backlog - c.prev_backlog)/100.0
         #delta = 1 + c.prev_delay*0.001
         c.prev_delay = c.prev_delay + delta
@@ -243,6 +350,20 @@ def mv_pressure_formula_3(c):
 # to perform a write request, and tick() to advance to the next tick in the
 # simulation.
 class coordinator:
+    # Note that the mv_pressure_* functions keep their own state as extra
+    # attributes on the coordinator object (alpha, prev_delay, ...), so
+    # those names must be listed here too - a new flow-control algorithm
+    # which wants to save a new variable needs to add it to this list.
+    __slots__ = ('id', 'base_replicas', 'view_replicas', 'nodes', 'write_CL',
+        'max_background_writes', 'mv_pressure', 'no_mv', 'ntick', 'issued',
+        'ongoing_writes', 'in_background', 'nbackground', 'flag_base',
+        'compact_threshold', 'throttled_writes',
+        'delayed_reply', 'delayed_heap', 'mv_delay_cache',
+        'mv_delay_cache_tick', 'stat_nticks', 'stat_nwrites',
+        'total_writes', 'nunreplied', 'metric_bg', 'metric_fg', 'metric_writes',
+        'metric_mv_delay',
+        # state of the various mv_pressure_* functions:
+        'alpha', 'prev_delay', 'prev_backlog')
     # write_CL is desired write consistency level. After CL replicas have
     # responded, the coordinator replies to client and moves this request to
     # "background" mode until the rest of the replicas have replied too.
@@ -254,21 +375,74 @@ class coordinator:
     def __init__(self, id, base_replicas, write_CL, max_background_writes, mv_pressure = mv_pressure_zero):
         self.id = id
         self.base_replicas = base_replicas
+        # The set of view replicas behind our base replicas doesn't change
+        # during the simulation, so collect them once here instead of
+        # re-filtering base_replicas on every view_backlog() call.
+        self.view_replicas = tuple(rep.view_replica
+            for rep in base_replicas if rep.view_replica)
+        # The full list of nodes the workload driver ticks every simulated
+        # tick, built once instead of collected into a fresh set on every
+        # all_nodes() call. The order is deterministic - each base replica
+        # followed by its view replica, and the coordinator last, so it
+        # collects the replicas' replies in the same tick they complete.
+        # (With the old arbitrary set iteration order, the coordinator
+        # could end up ticking before its replicas, making runs differ by
+        # a tick depending on hash seeds - the opposite of the reproducible
+        # graphs this simulator is for.)
+        nodes = []
+        for rep in base_replicas:
+            nodes.extend(rep.all_nodes())
+        nodes.append(self)
+        self.nodes = tuple(nodes)
         self.write_CL = write_CL
         self.max_background_writes = max_background_writes
         self.mv_pressure = mv_pressure
+        # Simulations of the plain base-table throttling (like the
+        # examples/throttling* ones) pass no mv_pressure at all. Notice
+        # this once here, so delay_reply() can skip the whole delay
+        # computation instead of rediscovering on every reply that the
+        # delay is always zero.
+        self.no_mv = mv_pressure is mv_pressure_zero
         self.ntick = 0
-        # ongoing_writes[rid] is the number of replica writes for rid that
-        # haven't yet been replied. It starts with len(base_replicas) and
-        # when gets to 0, it gets deleted from ongoing_writes.
-        self.ongoing_writes = {}
-        self.background_writes = set()
+        # issued is the log of request ids, in the order cql_write() sent
+        # them to the replicas. The replicas don't keep their own copy of
+        # this sequence - they only keep integer cursors into it (see the
+        # comment in replica.__init__), and tick() below reads the ids of
+        # the writes a replica newly completed as a slice of this log.
+        self.issued = []
+        # rids are allocated monotonically and never reused, so the issue
+        # log above and the in_background flag map below would grow for as
+        # long as the simulation runs. tick() calls compact() periodically
+        # (every compact_threshold collected writes) to drop the prefixes
+        # which can no longer be referenced, keeping memory bounded by the
+        # number of writes in flight, not the length of the run.
+        # flag_base is the rid corresponding to index 0 of the rid-indexed
+        # byte maps below (ongoing_writes and in_background).
+        self.flag_base = 0
+        self.compact_threshold = 65536
+        # ongoing_writes[rid - flag_base] is the number of replica writes
+        # for rid that haven't yet been replied. It starts with
+        # len(base_replicas) and drops back to 0 when the last replica
+        # replies. Since rids are small dense integers, a flat byte-per-
+        # rid map (extended as rids are allocated in cql_write) is cheaper
+        # than the dict of rid -> count this used to be.
+        self.ongoing_writes = bytearray()
+        # Which ongoing writes are "background" writes - i.e., already
+        # replied to the client but still waiting for more replicas. This
+        # used to be a set of rids; since rids are small dense integers, a
+        # flat byte-per-rid flag map (extended as rids are allocated in
+        # cql_write) plus an explicit count is cheaper than a hash set.
+        self.in_background = bytearray()
+        self.nbackground = 0
         # throttled writes are ongoing writes which reached CL and we
-        # wanted to move them to background_writes, but couldn't because
-        # background_writes reached its limit. When background_writes
-        # becomes shorter, we'll immediately move some items from
-        # throttled_writes to backround_writes.
-        self.throttled_writes = set()
+        # wanted to move them to the background, but couldn't because
+        # the number of background writes reached its limit. When that
+        # number drops, we'll immediately move the oldest throttled
+        # writes to the background. A write which completes while still
+        # throttled leaves its deque entry behind; tick() recognizes such
+        # stale entries (the write is no longer ongoing) and drops them
+        # when they reach the front.
+        self.throttled_writes = deque()
         # when delayed_reply[rid] is set, it means we wanted to reply to
         # request but decided to delay that reply until later. The content
         # of delayed_reply[rid] is the tick when to do this reply.
@@ -277,7 +451,34 @@ class coordinator:
         # delayed_reply[] items is added to unreplied_writes().
         # We use delayed_reply as a flow control mechanism to control MV
         # update backlog.
+        # delayed_heap keeps the same deadlines as a min-heap of
+        # (deadline, rid) pairs, so that each tick we can pop just the
+        # entries whose time has come instead of scanning the whole dict.
+        # The dict remains authoritative: a heap entry whose deadline
+        # doesn't match delayed_reply[rid] is stale and is ignored when
+        # popped (the usual lazy-deletion trick).
         self.delayed_reply = {}
+        self.delayed_heap = []
+        # delay_reply() can be called several times in the same tick (one
+        # CL event per completed write), but nothing mv_pressure() looks at
+        # changes in the middle of a tick, so we compute the delay at most
+        # once per tick and reuse it (see delay_reply()).
+        self.mv_delay_cache = 0
+        self.mv_delay_cache_tick = -1
+        # State of the various mv_pressure_* functions. They used to
+        # lazily initialize these with a hasattr() check on every call,
+        # which is both slow on the hot path and incompatible with
+        # __slots__, so the defaults live here instead.
+        self.alpha = 1.0
+        self.prev_delay = 0.0
+        self.prev_backlog = 0
+        # Incrementally-maintained count of unreplied ("foreground")
+        # requests, always equal to
+        # len(ongoing_writes) - nbackground + len(delayed_reply).
+        # The workload driver checks this every tick, so we keep it updated
+        # as writes start, get replied and get delayed, instead of
+        # recomputing the three lengths each time.
+        self.nunreplied = 0
         self.reset_stats()
         self.total_writes = 0
         self.metric_bg = metric("coordinator_%d_background_writes" % (id))
@@ -291,106 +492,221 @@ class coordinator:
     # concurrency shouldn't send more writes if unreplied_writes() is above
     # its concurrency limit.
     def unreplied_writes(self):
-        return len(self.ongoing_writes) - len(self.background_writes) + len(self.delayed_reply)
-    def cql_write(self, rid):
+        return self.nunreplied
+    # Start a new write. The request id is assigned here, not by the
+    # caller: all the rid-indexed structures (and compact(), which
+    # windows them) rely on rids growing monotonically forever, and a
+    # workload loop's tick index restarts from 0 on every workload_*()
+    # call - running several workloads in sequence on one coordinator is
+    # a supported pattern. Since ids are consecutive, each write simply
+    # extends the byte maps by its own entry.
+    def cql_write(self):
+        rid = self.total_writes
+        self.issued.append(rid)
+        self.in_background.append(0)
+        self.ongoing_writes.append(len(self.base_replicas))
         for rep in self.base_replicas:
             rep.write(rid)
-        self.ongoing_writes[rid] = len(self.base_replicas)
+        self.nunreplied += 1
         self.stat_nwrites += 1
         self.total_writes += 1
+    # Drop the prefix of the issue log which every base replica has
+    # already collected - those entries can never be referenced again -
+    # and shift the base replicas' cursors down to match (all the cursor
+    # arithmetic is relative, so they don't notice). Similarly drop the
+    # rid-indexed byte maps below the oldest rid still in the log. This
+    # caps all these structures at roughly the number of writes in
+    # flight.
+    def compact(self):
+        m = min(rep.ncollected for rep in self.base_replicas)
+        if m:
+            del self.issued[:m]
+            for rep in self.base_replicas:
+                rep.nwritten -= m
+                rep.nreplied -= m
+                rep.ncollected -= m
+        if self.issued:
+            new_base = self.issued[0]
+        else:
+            new_base = self.flag_base + len(self.in_background)
+        if new_base > self.flag_base:
+            del self.in_background[:new_base - self.flag_base]
+            del self.ongoing_writes[:new_base - self.flag_base]
+            self.flag_base = new_base
     # Call delayed_reply() after already "replying" (a connection is "replied"
     # when it is put in background_writes, or deleted completely from
     # ongoing_writes). This will cause unreplied_writes() to continue counting
     # this connection as unreplied for a while longer. The length of the
     # while is determined by mv_pressure().
     def delay_reply(self, rid):
-        delay = self.mv_pressure(self)
-        # Add random jitter in (-500,500):
-        #delay += (random()-0.5)*2000
-        # Random multiplicative jitter
-        #delay *= 1 + random()
-        # Add one-side random jitter in (0,500)
-        #delay += random()*500
-        # Add one-side random jitter in (0,500)
-        #delay -= random()*500
-        # Add consistent error, positive or negative. Does not make any
-        # difference because if we do delay -= 500 here, the algorithm just
-        # converges to the delay that when 500 is subtracted from it, is
-        # the right delay we need!
-        # delay += 500
-
-        # Note that to set the delayed_reply array, the delay must be a
-        # positive integer.
-        delay = int(delay)
+        if self.no_mv:
+            # No MV flow control - the delay is always zero, so just
+            # record it for the metric and don't delay anything.
+            self.metric_mv_delay.out(self.ntick, 0)
+            return
+        # The state mv_pressure() inspects (view backlogs, etc.) doesn't
+        # change within a tick, so if we already computed the delay this
+        # tick, reuse it instead of recomputing. Note this also means the
+        # mv_pressure functions which update their own state (e.g., alpha)
+        # on every call now take at most one adaptation step per tick.
+        if self.mv_delay_cache_tick != self.ntick:
+            delay = self.mv_pressure(self)
+            # Add random jitter in (-500,500):
+            #delay += (random()-0.5)*2000
+            # Random multiplicative jitter
+            #delay *= 1 + random()
+            # Add one-side random jitter in (0,500)
+            #delay += random()*500
+            # Add one-side random jitter in (0,500)
+            #delay -= random()*500
+            # Add consistent error, positive or negative. Does not make any
+            # difference because if we do delay -= 500 here, the algorithm just
+            # converges to the delay that when 500 is subtracted from it, is
+            # the right delay we need!
+            # delay += 500
+
+            # Note that to set the delayed_reply array, the delay must be a
+            # positive integer.
+            self.mv_delay_cache = int(delay)
+            self.mv_delay_cache_tick = self.ntick
+        delay = self.mv_delay_cache
         self.metric_mv_delay.out(self.ntick, delay)
         if delay <= 0:
             return
         self.delayed_reply[rid] = self.ntick + delay
+        self.nunreplied += 1
+        heapq.heappush(self.delayed_heap, (self.ntick + delay, rid))
     def tick(self):
-        throttling = len(self.background_writes) >= self.max_background_writes
+        if self.base_replicas[0].ncollected >= self.compact_threshold:
+            self.compact()
+        throttling = self.nbackground >= self.max_background_writes
         # If previously, while background writes reached its limit, we
         # moved requests to throttled_writes instead of background_writes,
         # and if now the background writes are below the limit, move as many
         # throttled writes as we can to the background_writes (in other words,
         # reply to these requests)
         while not throttling and self.throttled_writes:
-            # note that this pops a random request from throttled_writes.
-            # it doesn't make any FIFO guarantee.
-            rid = self.throttled_writes.pop()
-            self.background_writes.add(rid)
+            rid = self.throttled_writes.popleft()
+            i = rid - self.flag_base
+            if i < 0 or not self.ongoing_writes[i]:
+                # Stale entry - this write completed (and was dropped
+                # from ongoing_writes) while it waited throttled.
+                continue
+            self.in_background[i] = 1
+            self.nbackground += 1
+            self.nunreplied -= 1
             self.delay_reply(rid)
-            throttling = len(self.background_writes) >= self.max_background_writes
+            throttling = self.nbackground >= self.max_background_writes
         # Execute delayed replies, if the time is right. Currently, we don't
         # really need to "reply" anything, just removing the delayed_reply
         # entry reduces the unreplied_writes() so tells the fixed-concurrency
         # client that it can send a new request.
-        remove = []
-        for key, value in self.delayed_reply.items():
-            if value == self.ntick:
-                remove.append(key)
-        for key in remove:
-            del self.delayed_reply[key]
-
+        # (This used to collect the expiring keys into a list and then
+        # delete them in a second pass over that list; the heap pops the
+        # expiring entries directly, so no temporary list is needed.)
+        delayed_heap = self.delayed_heap
+        delayed_reply = self.delayed_reply
+        while delayed_heap and delayed_heap[0][0] <= self.ntick:
+            deadline, rid = heapq.heappop(delayed_heap)
+            if delayed_reply.get(rid) == deadline:
+                del delayed_reply[rid]
+                self.nunreplied -= 1
+
+        # Every base replica replies to the same stream of rids in the
+        # same order, so iterating the replicas' newly-replied slices of
+        # the issue log one replica at a time would touch the same rid's
+        # ongoing count once per replica. Instead, cut the stream
+        # positions into segments covered by a constant number of the
+        # replicas' [ncollected:nreplied) windows - there are at most two
+        # boundaries per replica - and handle each rid once, applying all
+        # of this tick's replies to it in one step.
+        deltas = {}
         for rep in self.base_replicas:
-            for rid in rep.replies:
-                self.ongoing_writes[rid] -= 1
-                if self.ongoing_writes[rid] == 0:
-                    # Done with all replica writes. No longer ongoing write.
-                    self.background_writes.discard(rid)
-                    self.throttled_writes.discard(rid)
-                    del self.ongoing_writes[rid]
-                    # It is likely we already considered this write "replied"
-                    # when it was already in background_writes, and if so
-                    # delay_reply() was already called for it. In that case
-                    # don't calculate a new delay.
-                    if not rid in self.delayed_reply:
-                        self.delay_reply(rid)
-                elif len(self.base_replicas) - self.ongoing_writes[rid] == self.write_CL:
-                    # This write reached CL and we can reply to the client
-                    # immediately, if not throttling. replying to the client
-                    # means adding this request id to background_writes, i.e,
-                    # the write continues in the background after the reply.
+            if rep.ncollected != rep.nreplied:
+                deltas[rep.ncollected] = deltas.get(rep.ncollected, 0) + 1
+                deltas[rep.nreplied] = deltas.get(rep.nreplied, 0) - 1
+                rep.ncollected = rep.nreplied
+        # The loop below runs for every write completed this tick, so
+        # hoist the attribute lookups it repeats out of the loop.
+        ongoing_writes = self.ongoing_writes
+        in_background = self.in_background
+        flag_base = self.flag_base
+        issued = self.issued
+        replies_needed_for_CL = len(self.base_replicas) - self.write_CL
+        bounds = sorted(deltas)
+        cnt = 0
+        for a, b in zip(bounds, bounds[1:]):
+            cnt += deltas[a]
+            if not cnt:
+                continue
+            for rid in issued[a:b]:
+                i = rid - flag_base
+                old = ongoing_writes[i]
+                remaining = old - cnt
+                ongoing_writes[i] = remaining
+                if replies_needed_for_CL and \
+                        old > replies_needed_for_CL >= remaining:
+                    # This write reached CL this tick and we can reply to
+                    # the client immediately, if not throttling. Replying
+                    # to the client means marking this request as a
+                    # background write, i.e., the write continues in the
+                    # background after the reply.
                     if throttling:
                         # Remember that we wanted to reply to this write
-                        # (move it to background_writes) but couldn't.
-                        # We'll do it later when the number of background
+                        # (move it to the background) but couldn't. We'll
+                        # do it later when the number of background
                         # writes drops.
-                        self.throttled_writes.add(rid)
+                        self.throttled_writes.append(rid)
                     else:
-                        self.background_writes.add(rid)
-                        self.delay_reply(rid) 
-            rep.replies.clear()
+                        in_background[i] = 1
+                        self.nbackground += 1
+                        self.nunreplied -= 1
+                        self.delay_reply(rid)
+                if remaining == 0:
+                    # Done with all replica writes. No longer ongoing write.
+                    if in_background[i]:
+                        in_background[i] = 0
+                        self.nbackground -= 1
+                        self.nunreplied += 1
+                    # (If this write was still throttled, its stale
+                    # deque entry is dropped when it reaches the front.)
+                    self.nunreplied -= 1
+                    # It is likely we already considered this write "replied"
+                    # when it reached CL (above, or in an earlier tick),
+                    # and if so delay_reply() was already called for it.
+                    # In that case don't calculate a new delay.
+                    if not rid in delayed_reply:
+                        self.delay_reply(rid)
         self.ntick += 1
         self.stat_nticks += 1
         self.metric_fg.out(self.ntick, self.unreplied_writes())
-        self.metric_bg.out(self.ntick, len(self.background_writes))
+        self.metric_bg.out(self.ntick, self.nbackground)
         self.metric_writes.out(self.ntick, self.total_writes)
+    # Advance k ticks at once. The caller has already verified that the
+    # coordinator has nothing to do in these ticks - no uncollected replica
+    # replies, no delayed reply expiring, no throttled write that could
+    # move to the background - so only the tick counters and the per-tick
+    # metric samples (whose values stay constant) need to advance.
+    def tick_skip(self, k):
+        ntick = self.ntick
+        self.metric_fg.out_run(ntick + 1, k, self.nunreplied)
+        self.metric_bg.out_run(ntick + 1, k, self.nbackground)
+        self.metric_writes.out_run(ntick + 1, k, self.total_writes)
+        self.ntick = ntick + k
+        self.stat_nticks += k
     def all_nodes(self):
-        ret = set()
-        ret.add(self)
-        for rep in self.base_replicas:
-            ret.update(rep.all_nodes())
-        return ret
+        return self.nodes
+    # Advance the whole simulated cluster - every replica, every view
+    # replica, and then this coordinator (which collects the replies the
+    # replicas just produced) - by one tick, or by k eventless ticks.
+    # Having the coordinator drive the sweep keeps the node order
+    # deterministic and leaves the workload loop a single call per tick.
+    def tick_all(self):
+        for node in self.nodes:
+            node.tick()
+    def tick_skip_all(self, k):
+        for node in self.nodes:
+            node.tick_skip(k)
     # Return an estimate of the view-update backlog which this coordinator
     # should use to decide how much to delay the client to stop the growth
     # of this view backlog.
@@ -405,27 +721,129 @@ class coordinator:
     # a smaller queue shortens, giving the impression that we're fine
     # because the sum is no longer growing.
     def view_backlog(self):
-        return max(len(rep.view_replica.requests) if rep.view_replica else 0 for rep in c.base_replicas)
+        if not self.view_replicas:
+            return 0
+        return max(v.pending() for v in self.view_replicas)
 
 ###############################################################################
 
 average_window_ticks = 2000
 metric_avg_throughput = metric("coordinator_avg_throughput_%s_ticks" % (average_window_ticks))
 
+# Helpers for building a concurrency schedule - a list giving the
+# client's desired concurrency at each tick - for
+# workload_variable_concurrency below. Precomputing the whole schedule
+# once is much cheaper than calling a Python function on every tick of
+# the main loop, and also lets the loop's event skip look ahead at the
+# schedule.
+def concurrency_schedule(f, ticks):
+    return [f(t) for t in range(int(ticks))]
+
+def concurrency_linear(start, end, ticks):
+    nticks = int(ticks)
+    return [start + (end - start) * t / nticks for t in range(nticks)]
+
+# client_concurrency may be a number (fixed concurrency), a schedule
+# list as built by the concurrency_* helpers above, or a function
+# mapping the tick number to the concurrency at that tick. A function is
+# precomputed into a schedule up front, so it must depend only on its
+# tick argument.
 def workload_variable_concurrency(c, client_concurrency, ticks):
     all_nodes = list(c.all_nodes())
-    for i in range(int(ticks)):
-        if c.unreplied_writes() < client_concurrency(i):
-            c.cql_write(i)
-        for node in all_nodes:
-            node.tick()
+    all_replicas = [node for node in all_nodes if node is not c]
+    # The loop below runs once per simulated tick; bind the bound
+    # methods and the (stable) coordinator structures it consults up
+    # front, instead of looking them up through attribute access on
+    # every iteration.
+    tick_all = c.tick_all
+    cql_write = c.cql_write
+    delayed_heap = c.delayed_heap
+    throttled_writes = c.throttled_writes
+    base_replicas = c.base_replicas
+    nticks = int(ticks)
+    if callable(client_concurrency):
+        client_concurrency = concurrency_schedule(client_concurrency, nticks)
+    if isinstance(client_concurrency, list):
+        schedule = client_concurrency
+        concurrency = 0
+    else:
+        schedule = None
+        concurrency = client_concurrency
+    i = 0
+    while i < nticks:
+        if schedule is not None:
+            concurrency = schedule[i]
+        if c.nunreplied < concurrency:
+            cql_write()
+        tick_all()
         if i % average_window_ticks == 0:
             metric_avg_throughput.out(c.ntick, (c.stat_nwrites / c.stat_nticks))
             print("%s: average over last 2000 ticks: requests/tick: %s" % (i, c.stat_nwrites / c.stat_nticks))
             c.reset_stats()
+        i += 1
+        # Event skip: most ticks are complete no-ops - the client is
+        # blocked on its concurrency limit, every replica is still
+        # accumulating fractions of a request, and no delayed reply
+        # expires. Rather than grinding through them one at a time, find
+        # how many upcoming ticks are guaranteed to be eventless and let
+        # every node skip over them in one call. This changes nothing in
+        # the simulation - it only avoids interpreting ticks whose outcome
+        # we already know.
+        if schedule is not None:
+            if i < nticks and schedule[i] > c.nunreplied:
+                # The client will write next tick.
+                continue
+        elif c.nunreplied < concurrency:
+            # The client may write next tick.
+            continue
+        # Don't skip over a stats-window boundary.
+        skip = (-i) % average_window_ticks
+        if skip == 0:
+            continue
+        if nticks - i < skip:
+            skip = nticks - i
+        if throttled_writes and \
+                c.nbackground < c.max_background_writes:
+            # A throttled write can move to the background next tick.
+            continue
+        if delayed_heap:
+            d = delayed_heap[0][0] - c.ntick
+            if d < skip:
+                skip = d
+        for rep in base_replicas:
+            if rep.ncollected != rep.nreplied:
+                # The coordinator has replies to collect next tick.
+                skip = 0
+                break
+        if skip <= 0:
+            continue
+        for rep in all_replicas:
+            if rep.nwritten > rep.nreplied and rep.speed_fp > 0:
+                # The largest d for which d more ticks still leave the
+                # replica's completion counter below FP_ONE, i.e., with
+                # no request completing. Integer fixed-point accounting
+                # makes this bound exact, so we can skip right up to it.
+                d = (FP_ONE - 1 - rep.completion_fp) // rep.speed_fp
+                if d < skip:
+                    skip = d
+        if skip <= 0:
+            continue
+        if schedule is not None:
+            # Only skip ticks in which the schedule keeps the client
+            # blocked (its concurrency stays at or below the number of
+            # unreplied writes).
+            nunreplied = c.nunreplied
+            k = 0
+            while k < skip and schedule[i + k] <= nunreplied:
+                k += 1
+            skip = k
+            if skip <= 0:
+                continue
+        c.tick_skip_all(skip)
+        i += skip
 
 def workload_fixed_concurrency(c, client_concurrency, ticks):
-    workload_variable_concurrency(c, lambda t: client_concurrency, ticks)
+    workload_variable_concurrency(c, client_concurrency, ticks)
 
 
 # TODO: Add the following examples to examples in the examples/ directory
@@ -467,18 +885,23 @@ def workload_fixed_concurrency(c, client_concurrency, ticks):
 
 def flush_metrics():
     for metric in all_metrics:
+        metric.flush()
         metric.f.flush()
 
 def close_metrics():
     for metric in all_metrics:
+        metric.flush()
         metric.f.close()
     all_metrics.clear()
 
 def plot(out,cmd):
-    # We use close_metrics() to flush and close all the data files so we
-    # can plot them. This means one cannot continue the simulation after
-    # the first plot.
-    close_metrics()
+    # subprocess (like gnuplot itself) is only needed when plotting, so
+    # don't make the simulation itself pay for loading it.
+    import subprocess
+    # Flush all the data files so gnuplot can see the data so far. Unlike
+    # the close_metrics() we once did here, this keeps the metrics alive,
+    # so a simulation can continue - and plot again - after a plot.
+    flush_metrics()
     print("plotting %s" % (out))
     subprocess.run(['gnuplot'], encoding='UTF-8', input="""
     #set terminal png size 1400,800 enhanced font "Sans,18"